@@ -1,11 +1,10 @@
 #!/usr/bin/python3
 
-import argparse, csv
-import regex
+import argparse, csv, functools, mmap, multiprocessing, operator, os, re
 import usfmtc
-import xml.etree.ElementTree as et
+import lxml.etree as et
 from usfmtc.usfmparser import Grammar
-from usfmtc.reference import Ref, RefRange, allbooks, bookcodes
+from usfmtc.reference import Ref, RefRange, allbooks, bookcodes, oneChbooks
 
 
 category_types = {
@@ -13,15 +12,31 @@ category_types = {
     "para": ["header", "introduction", "list", "otherpara", "sectionpara", "title", "versepara"]
 }
 categories = {v: k for k, l in category_types.items() for v in l}
+markercats = Grammar.marker_categories
+stylecats = {s: categories.get(c, None) for s, c in markercats.items()}
+
+_RE_HEADING = re.compile(r"<p class=\|(?P<p>.*?)\|>(?P<pbody>.*?)(?=$|<(?:p|span|div))"
+                         r"|<span class=\|(?P<span>.*?)\|>(?P<spanbody>.*?)(?:</span>|$)"
+                         r"|<div class=\|(?P<div>.*?)\|>(?P<divbody>.*?)(?:</div>|$)")
+_RE_A = re.compile(r"<a.*?>(.*?)</a>")
+_RE_I = re.compile(r"</?i>")
+_RE_FNV = re.compile(r"<span class=\|fnv\|>(.*?)</span>")
+_RE_END = re.compile(r"</(?:span|div)>")
+_RE_PCLASS_ANY = re.compile(r"<p class=\|(.*?)\|>")
+_RE_VERSEID = re.compile(r"(\d?\s*\D+)\s*(\d+):(\d+)")
+_RE_REF = re.compile(r"((?:\d\s*)?\S+)\s*(\d+):(\d+)([-\u2013](\d+)(:(\d+))?)?")
+_RE_ACROSTIC = re.compile(r"(.*?)<br> (.*)")
+_RE_FNKEY = re.compile(r"(.*?)(?:\[(\d+)\])?$")
+_RE_NUMBERS = re.compile(r"^[\d,]+$")
 
 def ensurespace(n):
-    if not len(n):
-        if n.text and not n.text[-1] in " \n":
-            n.text += " "
-    elif n[-1].tail and not n[-1].tail[-1] in " \n":
-        n[-1].tail += " "
-    else:
-        ensurespace(n[-1])
+    while len(n):
+        if n[-1].tail and not n[-1].tail[-1] in " \n":
+            n[-1].tail += " "
+            return
+        n = n[-1]
+    if n.text and not n.text[-1] in " \n":
+        n.text += " "
 
 class Style:
     def __init__(self, styles, after=None):
@@ -30,24 +45,27 @@ class Style:
         self.styles = styles
         self.after = after
 
-    def addto(self, parent, text=None, ispar=False, verse=None):
+    def addto(self, parent, text=None, ispar=False, verse=None, root=None):
         res = None
         for s in self.styles:
             if s == "b" and parent is not None \
-                    and Grammar.marker_categories.get(parent.get("style", None), None) == "sectionpara":
+                    and markercats.get(parent.get("style", None), None) == "sectionpara":
                 continue
-            t = categories.get(Grammar.marker_categories.get(s, ""), None)
+            t = stylecats.get(s, None)
             if t is None:
                 continue
             if t == "para" or ispar:
-                while parent.parent is not None:
-                    parent = parent.parent
+                if root is not None:
+                    parent = root
+                else:
+                    while parent.parent is not None:
+                        parent = parent.parent
             if ispar and t != "para":
                 pres = parent.makeelement("para", {"style": "p"})
                 parent.append(pres)
                 parent = pres
             if verse is not None and t != "para":
-                pres = parent.makeelement("verse", {"style": "v", "number": str(verse.verse)})
+                pres = parent.makeelement("verse", {"style": "v", "number": str(verse)})
                 parent.append(pres)
                 verse = None
             if t != "para":
@@ -61,7 +79,7 @@ class Style:
         elif text is not None:
             res.text = text
         if self.after is not None:
-            t = categories.get(Grammar.marker_categories.get(self.after, ""), None)
+            t = stylecats.get(self.after, None)
             if t is not None:
                 tnode = parent.makeelement(t, {"style": self.after})
                 parent.append(tnode)
@@ -72,14 +90,17 @@ class AcrosticStyle:
     def __init__(self, styles):
         self.styles = styles
 
-    def addto(self, parent, text=None, ispar=False, verse=None):
+    def addto(self, parent, text=None, ispar=False, verse=None, root=None):
         if text is None:
             return None
-        m = regex.match(r"(.*?)<br> (.*)", text)
+        m = _RE_ACROSTIC.match(text)
         if not m:
             return
-        while parent.parent is not None:
-            parent = parent.parent
+        if root is not None:
+            parent = root
+        else:
+            while parent.parent is not None:
+                parent = parent.parent
         para = None
         for i in range(2):
             para = parent.makeelement("para", {"style": self.styles[i]})
@@ -106,9 +127,12 @@ booktitles = {
 }
 
 bookmap = {booknames[i]: allbooks[i] for i in range(len(booknames))}
+codenames = {v: k for k, v in bookmap.items()}
 
 def canonref(s):
-    m = regex.search(r"((?:\d\s*)?\S+)\s*(\d+):(\d+)([-\u2013](\d+)(:(\d+))?)?", s)
+    if ":" not in s:
+        return (None, 0, 0)
+    m = _RE_REF.search(s)
     if not m:
         return (None, 0, 0)
     res = Ref(book=bookmap.get(m.group(1).strip()), chapter=int(m.group(2)), verse=int(m.group(3)))
@@ -120,6 +144,19 @@ def canonref(s):
         res = RefRange(res, res.copy(**kw))
     return (res, m.start(), m.end())
 
+# Formats the plain references canonref builds the same as str(), without the general Ref.str
+def refstr(r):
+    if isinstance(r, RefRange):
+        f, l = r.first, r.last
+        if f.book is None or f.book in oneChbooks or f.verse == l.verse:
+            return str(r)
+        if f.chapter == l.chapter:
+            return f"{f.book} {f.chapter}:{f.verse}-{l.verse}"
+        return f"{f.book} {f.chapter}:{f.verse}-{l.chapter}:{l.verse}"
+    if r.book is None or r.book in oneChbooks:
+        return str(r)
+    return f"{r.book} {r.chapter}:{r.verse}"
+
 
 ptypes = {
     "acrostic":         AcrosticStyle(["qa", "qa"]),
@@ -149,15 +186,49 @@ ptypes = {
     "tab1stlinered":    Style(["pmo", "wj"])
 }
 
-def debracket(s): return regex.sub(r"[\[\]{}]", "", s)
+# Yields (kind, class, body, start) per tag; class is None for a malformed tag and kind is
+# None for unknown text, after which scanning stops.
+def scanheading(s):
+    i = 0
+    n = len(s)
+    while i < n:
+        m = _RE_HEADING.match(s, i)
+        if m is None:
+            for kind in ("p", "span", "div"):
+                if s.startswith(f"<{kind} ", i):
+                    yield (kind, None, None, i)
+                    return
+            yield (None, None, None, i)
+            return
+        kind = "p" if m.group("p") is not None else ("span" if m.group("span") is not None else "div")
+        yield (kind, m.group(kind), m.group(kind + "body"), i)
+        i = m.end()
+
+debrackettable = str.maketrans("", "", "[]{}")
+
+def debracket(s): return s.translate(debrackettable)
+
+# Takes a path or an open binary stream
+def loadbooknames(source):
+    res = {}
+    for _, e in et.iterparse(source, events=("end",), tag="book"):
+        res.setdefault(e.get("code"), tuple(e.get(a, None) for a in ("long", "short", "abbr")))
+        e.clear()
+        while e.getprevious() is not None:
+            del e.getparent()[0]
+    return res
 
 class Processor:
     def __init__(self, outname, books=None, fnqs=None, names=None):
         self.doc = None
         self.currnode = None
-        self.cref = None
+        self.root = None
+        self.cbook = None
+        self.cchapter = None
+        self.cverse = None
         self.outname = outname
         self.books = books
+        self.bookprefixes = None if books is None else tuple(f"{n} " for n, c in bookmap.items() if c in books)
         self.fnqs = fnqs
         self.fncount = 0
         self.pendinglstrip = False
@@ -166,6 +237,7 @@ class Processor:
         self.verse_pending = False
 
     def writedoc(self):
+        self.root = None
         bk = self.doc.book
         if self.books is not None and bk not in self.books:
             return
@@ -175,16 +247,21 @@ class Processor:
         outfname = self.outname.replace("%", bk).replace('^', bkcode)
         print(f"Writing {outfname}")
         self.doc.saveAs(outfname)
+        return outfname
 
     def addheadline(self, row):
         self.fields = row
+        idx = {k: i for i, k in enumerate(row)}
+        self.getcols = operator.itemgetter(*(idx[k] for k in ('VerseId', 'Hdg', 'Crossref', 'Par',
+                        ' BSB version ', 'pnc', 'footnotes', 'End text')))
 
     def makebook(self, bk):
-        books = [booknames[allbooks.index(bk)], booknames[allbooks.index(bk)], bk]
+        name = codenames[bk]
+        books = [name, name, bk]
         if self.names is not None:
-            booke = self.names.find(f'.//book[@code="{bk}"]')
+            booke = self.names.get(bk)
             if booke is not None:
-                books = [booke.get(a, None) for a in ("long", "short", "abbr")]
+                books = list(booke)
         title1, title2 = booktitles.get(bk, (None, None))
         if title1 is None:
             title1, title2 = books[0].rsplit(' ', 1) if ' ' in books[0] else (books[0], "")
@@ -199,7 +276,7 @@ class Processor:
   <para style="mt1">{5}</para>
 </usx>""".format(bk, *books, title1, title2)
         doc = usfmtc.USX.fromUsx(template)
-        self.currnode = doc.getroot()
+        self.root = self.currnode = doc.getroot()
         return doc
 
     def appenddoc(self, parent, tag, style, **attrib):
@@ -213,36 +290,33 @@ class Processor:
         if txt.startswith("<br />"):
             txt = txt[6:]
         txt = txt.strip()
-        while len(txt):
-            if txt.startswith("<p "):
-                m = regex.match(r"<p class=\|(.*?)\|>(.*?)(?=$|<(?:p|span|div))", txt)
-                if not m:
-                    print(f"Heading p failed to parse: {txt}")
+        for kind, t, body, start in scanheading(txt):
+            if kind == "p":
+                if t is None:
+                    print(f"Heading p failed to parse: {txt[start:]}")
                     break
-                t = m.group(1)
                 if t == "pshdg" and self.verse_pending:
                     c = Style("d")
                 else:
                     c = ptypes.get(t, None)
                 if c is None:
-                    print(f"Missing ptype: {t} in {txt}")
+                    print(f"Missing ptype: {t} in {txt[start:]}")
                     break
-                self.currnode = c.addto(self.currnode, m.group(2).strip(), ispar=True,
-                                verse=self.cref if self.verse_pending and isversetext else None)
+                self.currnode = c.addto(self.currnode, body.strip(), ispar=True,
+                                verse=self.cverse if self.verse_pending and isversetext else None,
+                                root=self.root)
                 if isversetext and self.currnode.tag == "char":
                     self.verse_pending = False
-                txt = txt[m.end():]
-            elif txt.startswith("<span "):
-                m = regex.match(r"<span class=\|(.*?)\|>(.*?)(</span>|$)", txt)
-                if not m:
-                    print(f"Bad span: {txt}")
+            elif kind == "span":
+                if t is None:
+                    print(f"Bad span: {txt[start:]}")
                     break
-                c = ptypes.get(m.group(1), None)
+                c = ptypes.get(t, None)
                 if c is None:
-                    print(f"Missing ptype for span: {m.group(1)} in {txt}")
+                    print(f"Missing ptype for span: {t} in {txt[start:]}")
                     break
-                self.currnode = c.addto(self.currnode)
-                bits = regex.split(r"<a.*?>(.*?)</a>", m.group(2))
+                self.currnode = c.addto(self.currnode, root=self.root)
+                bits = _RE_A.split(body)
                 for i, b in enumerate(bits):
                     if i == 0:
                         self.currnode.text = b
@@ -250,37 +324,35 @@ class Processor:
                         c.tail = b
                     else:
                         bref, x, xx = canonref(b)
-                        c = self.currnode.makeelement("ref", {} if bref is None else {"loc": str(bref)})
+                        c = self.currnode.makeelement("ref", {} if bref is None else {"loc": refstr(bref)})
                         c.text = b
                         self.currnode.append(c)
-                txt = txt[m.end():]
-            elif txt.startswith("<div "):
-                m = regex.match(r"<div class=\|(.*?)\|>(.*?)(</div>|$)", txt)
-                if not m:
-                    print(f"Bad div: {txt}")
+            elif kind == "div":
+                if t is None:
+                    print(f"Bad div: {txt[start:]}")
                     break
-                c = ptypes.get(m.group(1), None)
+                c = ptypes.get(t, None)
                 if c is None:
-                    print(f"Missing ptype for div: {m.group(1)} in {txt}")
+                    print(f"Missing ptype for div: {t} in {txt[start:]}")
                     break
-                self.currnode = c.addto(self.currnode, m.group(2))
-                txt = txt[m.end():]
+                self.currnode = c.addto(self.currnode, body, root=self.root)
             else:
-                print(f"Unknown heading text to process: {txt}")
+                print(f"Unknown heading text to process: {txt[start:]}")
                 break
         self.pendinglstrip = False
 
     def addnote(self, txt):
-        bits = regex.split(r"</?i>", txt)
+        bits = _RE_I.split(txt)
         fnode = self.currnode.makeelement("note", {"style": "f", "caller": "+"})
         self.currnode.append(fnode)
-        if self.cref:
+        if self.cverse is not None:
             currf = fnode.makeelement("char", {"style": "fr"})
-            currf.text = f"{self.cref.chapter}:{self.cref.verse} "
+            currf.text = f"{self.cchapter}:{self.cverse} "
             fnode.append(currf)
         fqs = []
         if self.fnqs is not None:
-            fqs = self.fnqs.get(str(self.cref) + ("" if self.fncount == 0 else f"[{self.fncount}]"), [])
+            cref = Ref(book=self.cbook, chapter=self.cchapter, verse=self.cverse)
+            fqs = self.fnqs.get((str(cref), self.fncount), [])
         qcount = 0
         for i, b in enumerate(bits):
             if not len(b):
@@ -292,19 +364,20 @@ class Processor:
             if r is None:
                 count = 0
                 vnode = currf
-                while (m := regex.search(r"<span class=\|fnv\|>(.*?)</span>", b)) is not None:
+                pos = 0
+                while "|fnv|" in b and (m := _RE_FNV.search(b, pos)) is not None:
                     if count == 0:
                         currf.text = b[:m.start()]
                     else:
-                        vnode.tail = b[:m.start()]
+                        vnode.tail = b[pos:m.start()]
                     n = currf.makeelement("char", {"style": "fv"})
                     currf.append(n)
                     n.text = m.group(1)
                     vnode = n
-                    b = b[m.end():]
+                    pos = m.end()
                     count += 1
                 if count > 0:
-                    vnode.tail = b
+                    vnode.tail = b[pos:]
                 elif b.startswith(" "):
                     prevf.text = (prevf.text or "") + " "
                     currf.text = b[1:]
@@ -312,7 +385,7 @@ class Processor:
                     currf.text = b
             else:
                 currf.text = b[:j]
-                rnode = currf.makeelement("ref", {"ref": str(r)})
+                rnode = currf.makeelement("ref", {"ref": refstr(r)})
                 currf.append(rnode)
                 rnode.text = b[j:e]
                 rnode.tail = b[e:]
@@ -320,14 +393,17 @@ class Processor:
         self.fncount += 1
 
     def addend(self, txt):
-        bits = regex.split(r"</(?:span|div)>", txt)
+        if "</" not in txt:
+            self.appendtext(txt)
+            return
+        bits = _RE_END.split(txt)
         for i, b in enumerate(bits):
             if i != 0:
                 self.currnode = self.currnode.parent
             self.appendtext(b)
 
     def appendverse(self):
-        vnode = self.currnode.makeelement("verse", {"style": "v", "number": str(self.cref.verse)})
+        vnode = self.currnode.makeelement("verse", {"style": "v", "number": str(self.cverse)})
         self.currnode.append(vnode)
         self.verse_pending = False
 
@@ -346,47 +422,52 @@ class Processor:
             self.currnode.text = (self.currnode.text or "") + txt
 
     def appendjunkytext(self, txt):
-        while (m := regex.search(r"<p class=\|(.*?)\|>", txt)) != None:
-            self.appendtext(txt[:m.start()])
+        pos = 0
+        while (m := _RE_PCLASS_ANY.search(txt, pos)) != None:
+            self.appendtext(txt[pos:m.start()])
             c = ptypes.get(m.group(1), None)
             if c is not None:
-                self.currnode = c.addto(self.currnode)
-            txt = txt[m.end():]
-        if txt:
-            self.appendtext(txt)
+                self.currnode = c.addto(self.currnode, root=self.root)
+            pos = m.end()
+        if pos < len(txt):
+            self.appendtext(txt[pos:])
 
     def processline(self, row):
-        f = {k: row[i] for i, k in enumerate(self.fields)}
-        if f['VerseId']:
-            m = regex.match(r"(\d?\s*\D+)\s*(\d+):(\d+)", f['VerseId'])
+        verseid, hdg, crossref, par, bsbtext, pnc, fnotes, endtext = self.getcols(row)
+        if self.skipping and not verseid.startswith(self.bookprefixes):
+            return
+        if verseid:
+            m = _RE_VERSEID.match(verseid)
             if m is not None:
-                lastref = self.cref
-                self.cref = Ref(book=bookmap[m.group(1).strip()], chapter=int(m.group(2)), verse=int(m.group(3)))
-                if self.doc is None or self.cref.book != self.doc.book:
+                bk = bookmap[m.group(1).strip()]
+                chap = int(m.group(2))
+                newchap = chap != self.cchapter
+                if self.doc is None or bk != self.doc.book:
                     if self.doc is not None:
                         self.writedoc()
-                    self.doc = self.makebook(self.cref.book)
-                    lastref = Ref(book=self.cref.book)
-                    self.skipping = self.books is not None and self.cref.book not in self.books
-                if lastref is None or self.cref.chapter != lastref.chapter:
-                    self.appenddoc(self.doc.getroot(), "chapter", "c", number=str(self.cref.chapter))
+                    self.doc = self.makebook(bk)
+                    newchap = True
+                    self.skipping = self.books is not None and bk not in self.books
+                self.cbook, self.cchapter, self.cverse = bk, chap, int(m.group(3))
+                if newchap:
+                    self.appenddoc(self.root, "chapter", "c", number=str(chap))
                 self.fncount = 0
                 self.verse_pending = True
         if self.skipping:
             return
-        if f['Hdg']:
-            self.addheading(f['Hdg'])
-        if f['Crossref']:
-            self.addheading(f['Crossref'])
-        if f['Par']:
-            self.addheading(f['Par'], isversetext=True)
+        if hdg:
+            self.addheading(hdg)
+        if crossref:
+            self.addheading(crossref)
+        if par:
+            self.addheading(par, isversetext=True)
         if row[17]:
             if not row[17].startswith("<span class=|reftext|"):
                 self.appendtext(" "+debracket(row[17]))
             self.pendinglstrip = True
-        if f[' BSB version ']:
-            t = debracket(f[' BSB version '])
-            if regex.match(r"^[\d,]+$", t):
+        if bsbtext:
+            t = debracket(bsbtext)
+            if _RE_NUMBERS.match(t):
                 t = " " + t + " "
             if "<p class=" in t:
                 self.appendjunkytext(t)
@@ -395,56 +476,117 @@ class Processor:
                     t = t.lstrip()
                     self.pendinglstrip = False
                 self.appendtext(t)
-        if f['pnc']:
-            self.addend(f['pnc'])
+        if pnc:
+            self.addend(pnc)
         if row[20]:
             self.addend(debracket(row[20]))
-        if f['footnotes']:
-            self.addnote(f['footnotes'])
-        if f['End text']:
-            self.addend(f['End text'])
-
-
-parser = argparse.ArgumentParser()
-parser.add_argument("infile",help="Input bsb_tables.csv file")
-parser.add_argument("-o","--outfile",help="Ouput usfm file template with %% for the book code, ^ for number")
-parser.add_argument("-f","--fnotes",help="Footnote styling tsv file")
-parser.add_argument("-b","--book",action="append",help="Book codes to include")
-parser.add_argument("-n","--names",help="BookNames.xml")
-args = parser.parse_args()
-
-fnqs = {}
-if args.fnotes:
-    with open(args.fnotes, encoding="utf-8") as inf:
-        rdr = csv.reader(inf, delimiter = "\t")
-        lastref = None
-        count = 0
-        for r in rdr:
-            if r[0] == lastref:
-                count += 1
-                key = f"{r[0]}[{count}]"
-            else:
-                count = 0
-                lastref = r[0]
-                key = r[0]
-            fnqs[key] = r[1:]
-
-if args.names is not None:
-    ndoc = et.parse(args.names)
-else:
-    ndoc = None
-
-job = Processor(args.outfile, books=args.book, fnqs=(fnqs if len(fnqs) else None), names=ndoc)
-with open(args.infile, encoding="utf-8") as inf:
-    rdr = csv.reader(inf, delimiter="\t")
+        if fnotes:
+            self.addnote(fnotes)
+        if endtext:
+            self.addend(endtext)
+
+
+# The BSB tables never quote fields, so a plain tab split matches csv.reader
+def readrows(path, start=0, end=None):
+    with open(path, "rb") as inf, mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if end is None:
+            end = len(mm)
+        mm.seek(start)
+        while mm.tell() < end:
+            yield mm.readline().decode("utf-8").rstrip("\r\n").split("\t")
+
+# Returns the header row and a (book, start, end) byte range of the table for each book.
+# The scan is cached per file version so repeated in-process runs skip it.
+def splitbooks(path):
+    st = os.stat(path)
+    return scanbooks(os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+@functools.lru_cache(maxsize=4)
+def scanbooks(path, mtime, size):
     hdr = None
+    shards = []
+    currbk = None
+    with open(path, "rb") as inf, mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        pos = 0
+        for line in iter(mm.readline, b""):
+            start, pos = pos, pos + len(line)
+            if hdr is None:
+                if not line.startswith(b"//"):
+                    hdr = line.decode("utf-8").rstrip("\r\n").split("\t")
+                    vidx = hdr.index("VerseId")
+                continue
+            v = line.split(b"\t", vidx+1)[vidx]
+            if not v or (m := _RE_VERSEID.match(v.decode("utf-8"))) is None:
+                continue
+            bk = bookmap[m.group(1).strip()]
+            if bk != currbk:
+                if len(shards):
+                    shards[-1][2] = start
+                shards.append([bk, start, pos])
+                currbk = bk
+        if len(shards):
+            shards[-1][2] = pos
+    return tuple(hdr), tuple(tuple(s) for s in shards)
+
+# Takes a path or an open text stream, e.g. an upload wrapped in io.TextIOWrapper
+def readfnotes(source):
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, encoding="utf-8") as inf:
+            return readfnotes(inf)
+    fnqs = {}
+    rdr = csv.reader(source, delimiter = "\t")
+    lastref = None
+    count = 0
     for r in rdr:
-        if hdr is None:
-            hdr = r
-            if r[0].startswith("//"):
-                hdr = None
-            else:
-                job.addheadline(r)
-            continue
+        if r[0] == lastref:
+            count += 1
+        else:
+            count = 0
+            lastref = r[0]
+            m = _RE_FNKEY.match(r[0])
+            ref, base = m.group(1), int(m.group(2) or 0)
+        fnqs[(ref, base + count)] = r[1:]
+    return fnqs
+
+def convertbook(infile, hdr, start, end, outfile, books, fnqs, names):
+    job = Processor(outfile, books=books, fnqs=fnqs, names=names)
+    job.addheadline(hdr)
+    for r in readrows(infile, start, end):
         job.processline(r)
-    job.writedoc()
+    return job.writedoc()
+
+# Returns the paths of the files written
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("infile",help="Input bsb_tables.csv file")
+    parser.add_argument("-o","--outfile",help="Ouput usfm file template with %% for the book code, ^ for number")
+    parser.add_argument("-f","--fnotes",help="Footnote styling tsv file")
+    parser.add_argument("-b","--book",action="append",help="Book codes to include")
+    parser.add_argument("-n","--names",help="BookNames.xml")
+    parser.add_argument("-j","--jobs",type=int,default=os.cpu_count(),help="Number of books to convert in parallel")
+    args = parser.parse_args(argv)
+
+    fnqs = readfnotes(args.fnotes) if args.fnotes else {}
+    ndoc = loadbooknames(args.names) if args.names is not None else None
+
+    hdr, shards = splitbooks(args.infile)
+    tasks = [(args.infile, hdr, start, end, args.outfile, args.book, (fnqs if len(fnqs) else None), ndoc)
+                for bk, start, end in shards if args.book is None or bk in args.book]
+    if args.jobs is None or args.jobs < 2 or len(tasks) < 2:
+        written = [convertbook(*t) for t in tasks]
+    else:
+        with multiprocessing.Pool(min(args.jobs, len(tasks))) as pool:
+            written = pool.starmap(convertbook, tasks)
+    return [f for f in written if f is not None]
+
+# Library entry point: runs a conversion in-process and returns an exit code rather than exiting
+def run(argv):
+    try:
+        main(argv)
+    except SystemExit as e:
+        return 0 if e.code is None else (e.code if isinstance(e.code, int) else 1)
+    return 0
+
+
+if __name__ == "__main__":
+    main()
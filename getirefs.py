@@ -1,31 +1,44 @@
 #!/usr/bin/python3
 
-import argparse, csv
+import argparse, csv, os
 import usfmtc
+from concurrent.futures import ProcessPoolExecutor
 
-parser = argparse.ArgumentParser()
-parser.add_argument("infile",nargs="+",help="Input usfm file")
-parser.add_argument("-o","--outfile",help="Ouput txt file")
-args = parser.parse_args()
+notestyles = frozenset(("fq", "fqa"))
 
-results = []
-for infile in args.infile:
+def noterefs(infile):
+    results = []
+    append = results.append
     doc = usfmtc.readFile(infile)
     doc.addorncv()
     for e, isin in doc.iterusx():
         if not isin or e.tag != "note":
             continue
-        ref = e.pos.ref
-        types = []
-        for c in e:
-            s = c.get("style", "")
-            if s in ("fq", "fqa"):
-                types.append(s)
-        if len(types):
-            results.append([ref] + types)
-
-if args.outfile:
-    with open(args.outfile, "w", encoding="utf-8") as outf:
-        wrtr = csv.writer(outf, delimiter="\t")
-        wrtr.writerow(["ref", "mrkrs"])
-        wrtr.writerows(results)
+        types = [s for c in e if (s := c.get("style", "")) in notestyles]
+        if types:
+            append((e.pos.ref, *types))
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("infile",nargs="+",help="Input usfm file")
+    parser.add_argument("-o","--outfile",help="Ouput txt file")
+    parser.add_argument("-j","--jobs",type=int,default=os.cpu_count(),help="Number of files to read in parallel")
+    args = parser.parse_args(argv)
+
+    results = []
+    if args.jobs is None or args.jobs < 2 or len(args.infile) < 2:
+        for infile in args.infile:
+            results.extend(noterefs(infile))
+    else:
+        with ProcessPoolExecutor(min(args.jobs, len(args.infile))) as ex:
+            for chunk in ex.map(noterefs, args.infile):
+                results.extend(chunk)
+
+    if args.outfile:
+        with open(args.outfile, "w", encoding="utf-8", newline="", buffering=1<<20) as outf:
+            csv.writer(outf, delimiter="\t").writerows([("ref", "mrkrs"), *results])
+
+
+if __name__ == "__main__":
+    main()